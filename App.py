@@ -1,21 +1,192 @@
 import os
+import io
+import hashlib
+import json
+import stat
+import queue
+import re
+import string
 import tempfile
+import contextlib
+import threading
+from itertools import chain
 import numpy as np
+import torch
 import faiss
 import nltk
-from pypdf import PdfReader
 from sentence_transformers import SentenceTransformer
 import gradio as gr
 import time
+from collections import OrderedDict
+from datasketch import MinHash, MinHashLSH
+from pathlib import Path
+from pdf_extract import iter_page_texts
+
+# ==================== إعدادات الترميز ====================
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+ENCODE_BATCH_SIZE = 64
+STREAM_BATCH_SIZE = 256
+
+# ==================== التخزين الدائم للفهارس ====================
+INDEX_CACHE_DIR = Path("/tmp/rag_cache")
+INDEX_CACHE_MAX_ENTRIES = 20
+# يُرفع عند تغيير صيغة الملفات المحفوظة أو طريقة بنائها
+INDEX_CACHE_VERSION = 1
+
+# ==================== إعدادات البحث ====================
+# حتى هذا العدد من الأجزاء يكون الضرب المباشر في numpy أسرع من FAISS
+EXACT_SEARCH_MAX_CHUNKS = 5000
+# فوق هذا العدد ننتقل إلى IVFPQ لضغط المتجهات 16 مرة
+IVF_MIN_CHUNKS = 10000
+
+# ==================== قالب عرض النتائج ====================
+# حدود درجات التشابه، وللدرجة i اللون والوصف في الموضع i
+SIMILARITY_THRESHOLDS = np.array([0.3, 0.5])
+SIMILARITY_COLORS = ("#dc3545", "#ffc107", "#28a745")  # أحمر، أصفر، أخضر
+SIMILARITY_LABELS = ("ضعيف", "جيد", "ممتاز")
+
+RESULT_TEMPLATE = string.Template("""
+                    <div style="background: #f8f9fa; border-radius: 10px; padding: 1.5rem; 
+                    margin: 1rem 0; border-left: 5px solid $sim_color; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
+                        <h4 style="margin-top: 0;">🏆 النتيجة #$rank</h4>
+                        <p style="margin-bottom: 0.5rem;">
+                            <span style="color: $sim_color; font-weight: bold;">التشابه: $percent% ($sim_text)</span> | 
+                            📖 الصفحة: $page | 
+                            🔢 الكلمات: $word_count
+                        </p>
+                        <hr style="margin: 0.5rem 0;">
+                        <p>$body...</p>
+                    </div>
+                    """)
+
+# ==================== إعدادات الذاكرة المؤقتة ====================
+QUERY_EMBEDDING_CACHE_SIZE = 512
+RESULT_CACHE_SIZE = 128
+RESULT_CACHE_TTL = 300  # ثوانٍ
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# أقصى مدة انتظار لتحميل النموذج في الخلفية
+MODEL_LOAD_TIMEOUT = 60  # ثوانٍ
+
+# ==================== استخراج النص ====================
+WORD_PATTERN = re.compile(r'\S+')
+
+# تقسيم النص إلى أجزاء 200 كلمة مع تداخل 40
+CHUNK_SIZE = 200
+CHUNK_OVERLAP = 40
+
+# سعة الطابور بين كل مرحلتين في خط المعالجة
+PIPELINE_QUEUE_SIZE = 4
+
+def iter_prefetched(iterable, maxsize=PIPELINE_QUEUE_SIZE):
+    """تشغيل مولّد في خيط منفصل يسبق المستهلك عبر طابور محدود"""
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+    errors = []
+    
+    def put(item):
+        # التوقف إذا توقف المستهلك بدلاً من الانتظار للأبد
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+            put(done)
+    
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+
+# ==================== إزالة التكرار ====================
+# الأجزاء التي يتجاوز تشابهها (Jaccard) هذا الحد تعتبر مكررة
+DEDUP_THRESHOLD = 0.9
+MINHASH_PERMUTATIONS = 128
+SHINGLE_SIZE = 3
+
+class ChunkDeduplicator:
+    """إزالة الأجزاء شبه المتطابقة قبل الترميز باستخدام MinHash/LSH"""
+    def __init__(self):
+        self.lsh = MinHashLSH(threshold=DEDUP_THRESHOLD, num_perm=MINHASH_PERMUTATIONS)
+        self.minhashes = []
+        self.kept_ids = []
+        self.original_pages = []
+        self.sources = {}
+    
+    def add(self, text, page_num):
+        """تسجيل جزء جديد، وإرجاع False إذا كان مكرراً"""
+        original_id = len(self.original_pages)
+        self.original_pages.append(page_num)
+        
+        words = text.split()
+        shingles = {
+            ' '.join(words[i:i + SHINGLE_SIZE]).encode('utf-8')
+            for i in range(max(1, len(words) - SHINGLE_SIZE + 1))
+        }
+        minhash = MinHash(num_perm=MINHASH_PERMUTATIONS)
+        minhash.update_batch(shingles)
+        
+        for kept_idx in self.lsh.query(minhash):
+            if self.minhashes[kept_idx].jaccard(minhash) > DEDUP_THRESHOLD:
+                self.sources.setdefault(kept_idx, [self.kept_ids[kept_idx]]).append(original_id)
+                return False
+        
+        kept_idx = len(self.minhashes)
+        self.lsh.insert(kept_idx, minhash)
+        self.minhashes.append(minhash)
+        self.kept_ids.append(original_id)
+        return True
 
 # ==================== تهيئة النظام ====================
 class FlowRAGSystem:
     def __init__(self):
         self.model = None
         self.index = None
-        self.chunks = None
+        self.embeddings = None
+        self.chunk_blob = None
+        self.chunk_offsets = None
+        self.chunk_pages = None
+        self.chunk_wordcounts = None
+        self.chunk_sources = None
+        self.original_pages = None
         self.current_file = None
+        self.gpu_resources = None
         self.is_ready = False
+        self.init_result = None
+        self.query_embedding_cache = OrderedDict()
+        self.result_cache = OrderedDict()
+        
+        # يحمي حالة المستند والذاكرة المؤقتة من التبديل أثناء البحث
+        self._state_lock = threading.Lock()
+        
+        # موارد FAISS على GPU وفهارسها لا تُستخدم من عدة خيوط في نفس الوقت
+        self._gpu_lock = threading.RLock()
+        
+        # تحميل النموذج في الخلفية حتى تظهر الواجهة فوراً
+        self._ready_event = threading.Event()
+        threading.Thread(target=self.initialize, daemon=True).start()
     
     def initialize(self):
         """تهيئة النظام"""
@@ -27,318 +198,716 @@ class FlowRAGSystem:
             except:
                 pass
             
-            self.model = SentenceTransformer(
-                "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-            )
+            # اختيار الجهاز: GPU مع FP16 إن وُجد، وإلا CPU بكل الأنوية
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            if device == "cpu":
+                try:
+                    torch.set_num_threads(os.cpu_count() or 1)
+                except Exception:
+                    pass
+            
+            # على CPU نستخدم ONNX Runtime لأنه أسرع من PyTorch بعدة مرات
+            self.model = None
+            if device == "cpu":
+                try:
+                    self.model = SentenceTransformer(MODEL_NAME, device=device, backend="onnx")
+                except Exception:
+                    self.model = None
+            
+            if self.model is None:
+                self.model = SentenceTransformer(MODEL_NAME, device=device)
+            
+            if device == "cuda":
+                try:
+                    self.model.half()
+                except Exception:
+                    pass
+            
+            # إنشاء موارد GPU مرة واحدة هنا بدلاً من إنشائها من عدة خيوط لاحقاً
+            try:
+                self._get_gpu_resources()
+            except Exception:
+                self.gpu_resources = None
             self.is_ready = True
-            return True
+            self.init_result = True
         except Exception as e:
-            return f"❌ خطأ في تحميل النموذج: {str(e)}"
+            self.init_result = f"❌ خطأ في تحميل النموذج: {str(e)}"
+        finally:
+            self._ready_event.set()
+        return self.init_result
+    
+    def _wait_until_ready(self):
+        """انتظار انتهاء تحميل النموذج في الخلفية"""
+        if not self.is_ready:
+            self._ready_event.wait(timeout=MODEL_LOAD_TIMEOUT)
+        return self.is_ready
+    
+    def _not_ready_message(self):
+        """رسالة الخطأ عند عدم جاهزية النموذج"""
+        if isinstance(self.init_result, str):
+            return self.init_result
+        return "⏳ النموذج قيد التحميل، حاول مرة أخرى بعد قليل"
+    
+    def _get_gpu_resources(self):
+        """موارد FAISS على GPU إن كانت متاحة، وإلا None"""
+        if self.gpu_resources is None:
+            if not hasattr(faiss, "StandardGpuResources") or not torch.cuda.is_available():
+                return None
+            if faiss.get_num_gpus() == 0:
+                return None
+            self.gpu_resources = faiss.StandardGpuResources()
+        return self.gpu_resources
+    
+    def _gpu_guard(self):
+        """قفل عمليات الفهرس عند استخدام GPU، ولا شيء على CPU"""
+        if self.gpu_resources is None:
+            return contextlib.nullcontext()
+        return self._gpu_lock
+    
+    def _index_for_disk(self, index):
+        """نسخة CPU من الفهرس صالحة للكتابة على القرص"""
+        if index is None or self.gpu_resources is None:
+            return index
+        with self._gpu_guard():
+            return faiss.index_gpu_to_cpu(index)
+    
+    def _create_index(self, dimension):
+        """إنشاء فهرس HNSW بمتجهات مخزنة بدقة FP16، أو فهرس مسطح على GPU"""
+        gpu_resources = self._get_gpu_resources()
+        if gpu_resources is not None:
+            config = faiss.GpuIndexFlatConfig()
+            config.useFloat16 = True
+            return faiss.GpuIndexFlatIP(gpu_resources, dimension, config)
+        
+        index = faiss.IndexHNSWSQ(
+            dimension, faiss.ScalarQuantizer.QT_fp16, 32, faiss.METRIC_INNER_PRODUCT
+        )
+        index.hnsw.efConstruction = 100
+        index.hnsw.efSearch = 64
+        return index
+    
+    def _create_ivf_index(self, embeddings):
+        """بناء فهرس IVFPQ مضغوط للمستندات الكبيرة"""
+        dimension = embeddings.shape[1]
+        nlist = int(2 * np.sqrt(len(embeddings)))
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, 16, 8, faiss.METRIC_INNER_PRODUCT)
+        # التدريب polysemous يضاعف زمن البحث بدون فائدة هنا
+        index.do_polysemous_training = False
+        index.train(embeddings)
+        index.add(embeddings)
+        index.nprobe = max(1, min(nlist // 4, 10))
+        
+        gpu_resources = self._get_gpu_resources()
+        if gpu_resources is not None:
+            with self._gpu_guard():
+                index = faiss.index_cpu_to_gpu(gpu_resources, 0, index)
+        return index
+    
+    def _add_embeddings(self, texts, index, embedding_batches):
+        """ترميز دفعة من الأجزاء وإضافتها إلى الفهرس، وإرجاع الفهرس"""
+        embeddings = self.model.encode(
+            texts,
+            batch_size=ENCODE_BATCH_SIZE,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+            convert_to_numpy=True
+        )
+        # المتجهات مطبّعة مسبقاً؛ FAISS يحتاج فقط float32 متصلة في الذاكرة
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        
+        # بعد الانتقال إلى IVFPQ تُضاف الدفعات مباشرة
+        if index is not None:
+            with self._gpu_guard():
+                index.add(embeddings)
+            return index
+        
+        # قبل ذلك تُحفظ الدفعات ولا يُبنى أي فهرس حتى يُعرف حجم المستند
+        embedding_batches.append(embeddings)
+        total = sum(len(batch) for batch in embedding_batches)
+        if total > IVF_MIN_CHUNKS:
+            index = self._create_ivf_index(np.vstack(embedding_batches))
+            embedding_batches.clear()
+        return index
+    
+    def _iter_chunks(self, pdf_bytes, deduplicator):
+        """استخراج الأجزاء النصية صفحةً بصفحة"""
+        # استخراج النص يعمل في خيط مستقل ويسبق التقسيم
+        for i, text in enumerate(iter_prefetched(iter_page_texts(pdf_bytes))):
+            if not text:
+                continue
+            
+            # مواقع بداية ونهاية كل كلمة في النص الأصلي
+            word_spans = np.fromiter(
+                chain.from_iterable(m.span() for m in WORD_PATTERN.finditer(text)),
+                dtype=np.int64
+            ).reshape(-1, 2)
+            if len(word_spans) == 0:
+                continue
+            
+            # حساب حدود كل الأجزاء دفعة واحدة
+            starts = np.arange(0, len(word_spans), CHUNK_SIZE - CHUNK_OVERLAP)
+            ends = np.minimum(starts + CHUNK_SIZE, len(word_spans))
+            
+            # كل جزء هو شريحة واحدة من النص بدون split/join
+            texts = [
+                text[word_spans[start, 0]:word_spans[end - 1, 1]]
+                for start, end in zip(starts, ends)
+            ]
+            wordcounts = (ends - starts).astype(np.int32)
+            
+            # حذف الأجزاء المكررة (ترويسات وتذييلات) قبل الترميز
+            keep = np.array([deduplicator.add(chunk, i + 1) for chunk in texts], dtype=bool)
+            texts = [chunk for chunk, kept in zip(texts, keep) if kept]
+            yield i + 1, texts, wordcounts[keep]
     
     def process_pdf(self, pdf_file):
         """معالجة ملف PDF"""
+        if not self._wait_until_ready():
+            return self._not_ready_message()
+        
         try:
-            self.current_file = pdf_file.name
-            
-            # حفظ الملف المؤقت
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                tmp_file.write(pdf_file.read())
-                pdf_path = tmp_file.name
-            
-            # قراءة PDF
-            reader = PdfReader(pdf_path)
-            pages_data = []
-            
-            for i, page in enumerate(reader.pages):
-                text = page.extract_text()
-                if text and text.strip():
-                    pages_data.append({
-                        'page': i + 1,
-                        'text': text.strip()
-                    })
-            
-            if not pages_data:
-                os.unlink(pdf_path)
-                return "❌ لم يتم العثور على نص في الملف"
+            file_name = getattr(pdf_file, "name", "مستند PDF")
             
-            # تقسيم النص
-            self.chunks = []
-            for page in pages_data:
-                words = page['text'].split()
-                
-                # تقسيم إلى أجزاء 200 كلمة مع تداخل 40
-                chunk_size = 200
-                overlap = 40
+            # قراءة PDF من الذاكرة مباشرة بدون ملف مؤقت
+            pdf_bytes = pdf_file if isinstance(pdf_file, bytes) else pdf_file.read()
+            
+            # إعادة استخدام فهرس محفوظ لنفس الملف إن وُجد
+            cache_key = self._cache_key(pdf_bytes)
+            cached = self._load_from_disk(cache_key)
+            if cached is not None:
+                page_count, document = cached
+                self._install_document(file_name, document)
+                return self._processed_message(page_count, document)
+            
+            # خط معالجة متداخل: استخراج ← تقسيم ← ترميز، كل مرحلة في خيط
+            # الفهرس يُبنى محلياً ولا يُثبَّت إلا مع بقية بيانات المستند
+            page_count = 0
+            index = None
+            chunk_blob = io.BytesIO()
+            chunk_offsets = [0]
+            chunk_pages = []
+            chunk_wordcounts = []
+            embedding_batches = []
+            buffer = []
+            deduplicator = ChunkDeduplicator()
+            
+            for page_num, texts, wordcounts in iter_prefetched(self._iter_chunks(pdf_bytes, deduplicator)):
+                page_count += 1
                 
-                start = 0
-                while start < len(words):
-                    end = start + chunk_size
-                    chunk_words = words[start:end]
-                    
-                    if chunk_words:
-                        self.chunks.append({
-                            'text': ' '.join(chunk_words),
-                            'page': page['page'],
-                            'word_count': len(chunk_words)
-                        })
-                    
-                    start += chunk_size - overlap
-            
-            # إنشاء embeddings
-            if len(self.chunks) > 0:
-                chunk_texts = [chunk['text'] for chunk in self.chunks]
-                embeddings = self.model.encode(
-                    chunk_texts,
-                    normalize_embeddings=True,
-                    show_progress_bar=False
-                )
+                for text in texts:
+                    chunk_offsets.append(chunk_offsets[-1] + chunk_blob.write(text.encode('utf-8')))
+                chunk_pages.append(np.full(len(texts), page_num, dtype=np.int32))
+                chunk_wordcounts.append(wordcounts)
                 
-                # بناء الفهرس
-                dimension = embeddings.shape[1]
-                self.index = faiss.IndexFlatIP(dimension)
-                faiss.normalize_L2(embeddings)
-                self.index.add(embeddings)
-            else:
-                os.unlink(pdf_path)
+                buffer.extend(texts)
+                if len(buffer) >= STREAM_BATCH_SIZE:
+                    index = self._add_embeddings(buffer, index, embedding_batches)
+                    buffer = []
+            
+            if buffer:
+                index = self._add_embeddings(buffer, index, embedding_batches)
+            
+            if page_count == 0:
+                return "❌ لم يتم العثور على نص في الملف"
+            
+            if len(chunk_offsets) == 1:
                 return "❌ لم يتم إنشاء أي أجزاء نصية"
             
-            # تنظيف الملف المؤقت
-            os.unlink(pdf_path)
+            # تخزين النصوص في كتلة واحدة مع مصفوفة إزاحات
+            chunk_pages = np.concatenate(chunk_pages)
+            document = {
+                'index': index,
+                'embeddings': None,
+                'chunk_blob': chunk_blob.getvalue(),
+                'chunk_offsets': np.array(chunk_offsets, dtype=np.int64),
+                'chunk_pages': chunk_pages,
+                'chunk_wordcounts': np.concatenate(chunk_wordcounts),
+                'chunk_sources': deduplicator.sources,
+                'original_pages': np.array(deduplicator.original_pages, dtype=np.int32),
+            }
+            
+            # فهرس واحد حسب الحجم: numpy حتى 5 آلاف، HNSW حتى 10 آلاف، ثم IVFPQ
+            if index is None:
+                embeddings = np.vstack(embedding_batches)
+                if len(embeddings) <= EXACT_SEARCH_MAX_CHUNKS:
+                    document['embeddings'] = embeddings
+                else:
+                    with self._gpu_guard():
+                        index = self._create_index(embeddings.shape[1])
+                        index.train(embeddings)
+                        index.add(embeddings)
+                    document['index'] = index
             
-            return f"✅ تم معالجة المستند بنجاح!\n📊 {len(pages_data)} صفحة → {len(self.chunks)} جزء نصي"
+            # نسخة الحفظ تُؤخذ قبل تثبيت الفهرس حتى لا تتزامن مع البحث عليه
+            disk_index = self._index_for_disk(document['index'])
+            self._install_document(file_name, document)
+            self._save_to_disk(cache_key, page_count, document, disk_index)
+            return self._processed_message(page_count, document)
             
         except Exception as e:
             return f"❌ خطأ في معالجة PDF: {str(e)}"
     
+    def _install_document(self, file_name, document):
+        """تثبيت الفهرس وكل بيانات المستند الجديد دفعة واحدة"""
+        with self._state_lock:
+            for name, value in document.items():
+                setattr(self, name, value)
+            self.current_file = file_name
+            
+            # مسح النتائج المحفوظة بعد تثبيت المستند الجديد، لا قبله،
+            # حتى لا تبقى نتائج بُنيت أثناء المعالجة
+            self.clear_cache()
+    
+    def _processed_message(self, page_count, document):
+        """رسالة نجاح معالجة المستند"""
+        chunk_count = len(document['chunk_pages'])
+        message = f"✅ تم معالجة المستند بنجاح!\n📊 {page_count} صفحة → {chunk_count} جزء نصي"
+        duplicates = len(document['original_pages']) - chunk_count
+        if duplicates:
+            message += f"\n♻️ تم حذف {duplicates} جزء مكرر"
+        return message
+    
+    def _cache_key(self, pdf_bytes):
+        """مفتاح الحفظ: محتوى الملف مع كل الإعدادات التي تغيّر الفهرس الناتج"""
+        settings = json.dumps([
+            INDEX_CACHE_VERSION, MODEL_NAME, CHUNK_SIZE, CHUNK_OVERLAP,
+            DEDUP_THRESHOLD, MINHASH_PERMUTATIONS, SHINGLE_SIZE,
+            EXACT_SEARCH_MAX_CHUNKS, IVF_MIN_CHUNKS
+        ])
+        return hashlib.sha256(settings.encode('utf-8') + pdf_bytes).hexdigest()
+    
+    def _get_cache_dir(self):
+        """مجلد التخزين الدائم، أو None إذا لم يكن آمناً للاستخدام"""
+        try:
+            INDEX_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            info = INDEX_CACHE_DIR.lstat()
+        except OSError:
+            return None
+        
+        # رفض الروابط الرمزية والمجلدات التي يملكها أو يكتب فيها مستخدم آخر
+        if not stat.S_ISDIR(info.st_mode) or info.st_mode & 0o077:
+            return None
+        if hasattr(os, "getuid") and info.st_uid != os.getuid():
+            return None
+        return INDEX_CACHE_DIR
+    
+    def _evict_cache(self, cache_dir):
+        """حذف أقدم المستندات المحفوظة عند تجاوز الحد الأقصى"""
+        entries = sorted(cache_dir.glob("*.npz"), key=lambda path: path.stat().st_mtime, reverse=True)
+        for path in entries[INDEX_CACHE_MAX_ENTRIES:]:
+            path.unlink(missing_ok=True)
+            path.with_suffix(".faiss").unlink(missing_ok=True)
+    
+    def _save_to_disk(self, cache_key, page_count, document, disk_index):
+        """حفظ الفهرس والبيانات على القرص لإعادة استخدامها"""
+        cache_dir = self._get_cache_dir()
+        if cache_dir is None:
+            return
+        
+        # أسماء مؤقتة فريدة حتى لا يتصادم حفظان متزامنان لنفس المستند
+        tmp_paths = []
+        try:
+            if disk_index is not None:
+                fd, index_tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+                os.close(fd)
+                tmp_paths.append(index_tmp)
+                faiss.write_index(disk_index, index_tmp)
+            
+            # مصفوفات numpy فقط (بدون pickle)، و chunk_sources بصيغة JSON
+            arrays = {
+                'page_count': np.array(page_count, dtype=np.int64),
+                'chunk_blob': np.frombuffer(document['chunk_blob'], dtype=np.uint8),
+                'chunk_offsets': document['chunk_offsets'],
+                'chunk_pages': document['chunk_pages'],
+                'chunk_wordcounts': document['chunk_wordcounts'],
+                'original_pages': document['original_pages'],
+                'chunk_sources': np.array(json.dumps(document['chunk_sources'])),
+            }
+            if document['embeddings'] is not None:
+                arrays['embeddings'] = document['embeddings']
+            
+            fd, data_tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            tmp_paths.append(data_tmp)
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            
+            # الفهرس أولاً ثم ملف البيانات، فوجود ملف البيانات يدل على اكتمال الحفظ
+            if disk_index is not None:
+                os.replace(index_tmp, cache_dir / f"{cache_key}.faiss")
+            os.replace(data_tmp, cache_dir / f"{cache_key}.npz")
+            
+            self._evict_cache(cache_dir)
+        except Exception:
+            # حذف ما تبقى من الملفات المؤقتة عند فشل الحفظ
+            for path in tmp_paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+    
+    def _load_from_disk(self, cache_key):
+        """تحميل فهرس محفوظ، وإرجاع (عدد الصفحات، بيانات المستند) أو None"""
+        cache_dir = self._get_cache_dir()
+        if cache_dir is None:
+            return None
+        
+        data_path = cache_dir / f"{cache_key}.npz"
+        if not data_path.exists():
+            return None
+        
+        try:
+            with np.load(data_path, allow_pickle=False) as data:
+                page_count = int(data['page_count'])
+                sources = json.loads(str(data['chunk_sources']))
+                document = {
+                    'index': None,
+                    'embeddings': data['embeddings'] if 'embeddings' in data.files else None,
+                    'chunk_blob': data['chunk_blob'].tobytes(),
+                    'chunk_offsets': data['chunk_offsets'],
+                    'chunk_pages': data['chunk_pages'],
+                    'chunk_wordcounts': data['chunk_wordcounts'],
+                    'chunk_sources': {int(idx): ids for idx, ids in sources.items()},
+                    'original_pages': data['original_pages'],
+                }
+            if document['embeddings'] is None:
+                document['index'] = faiss.read_index(str(cache_dir / f"{cache_key}.faiss"))
+            
+            # تحديث وقت الاستخدام حتى يُحذف الأقدم استخداماً أولاً
+            os.utime(data_path)
+        except Exception:
+            return None
+        
+        # فهارس HNSW المحفوظة من جهاز بدون GPU تبقى على CPU
+        gpu_resources = self._get_gpu_resources()
+        if document['index'] is not None and gpu_resources is not None:
+            try:
+                with self._gpu_guard():
+                    document['index'] = faiss.index_cpu_to_gpu(gpu_resources, 0, document['index'])
+            except Exception:
+                pass
+        
+        return page_count, document
+    
+    def get_chunk_pages(self, idx):
+        """أرقام الصفحات التي ظهر فيها الجزء (بما فيها نسخه المكررة)"""
+        sources = self.chunk_sources.get(int(idx))
+        if sources is None:
+            return str(self.chunk_pages[idx])
+        return '، '.join(str(page) for page in np.unique(self.original_pages[sources]))
+    
+    def get_chunk_text(self, idx):
+        """استرجاع نص جزء من الكتلة المخزنة"""
+        start, end = self.chunk_offsets[idx], self.chunk_offsets[idx + 1]
+        return self.chunk_blob[start:end].decode('utf-8')
+    
+    def clear_cache(self):
+        """مسح الذاكرة المؤقتة للاستعلامات والنتائج"""
+        self.query_embedding_cache.clear()
+        self.result_cache.clear()
+    
+    def _encode_query(self, query, key):
+        """حساب embedding للسؤال مع إعادة استخدام المحفوظ منه"""
+        embedding = self.query_embedding_cache.get(key)
+        if embedding is not None:
+            self.query_embedding_cache.move_to_end(key)
+            return embedding
+        
+        embedding = self.model.encode([query], normalize_embeddings=True)
+        embedding = np.ascontiguousarray(embedding, dtype=np.float32)
+        self.query_embedding_cache[key] = embedding
+        if len(self.query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+            self.query_embedding_cache.popitem(last=False)
+        return embedding
+    
+    def _lookup_result(self, key, top_k, query_embedding=None):
+        """البحث عن نتيجة محفوظة بتطابق تام أو بتشابه دلالي"""
+        now = time.time()
+        
+        # حذف النتائج المنتهية الصلاحية
+        expired = [k for k, (ts, _, _) in self.result_cache.items() if now - ts > RESULT_CACHE_TTL]
+        for k in expired:
+            del self.result_cache[k]
+        
+        if query_embedding is None:
+            cache_key = (key, top_k)
+            if cache_key in self.result_cache:
+                self.result_cache.move_to_end(cache_key)
+                return self.result_cache[cache_key][2]
+            return None
+        
+        candidates = [k for k in self.result_cache if k[1] == top_k]
+        if not candidates:
+            return None
+        
+        cached_matrix = np.vstack([self.result_cache[k][1] for k in candidates])
+        similarities = np.dot(cached_matrix, query_embedding.T).ravel()
+        best = int(np.argmax(similarities))
+        if similarities[best] >= SEMANTIC_CACHE_THRESHOLD:
+            self.result_cache.move_to_end(candidates[best])
+            return self.result_cache[candidates[best]][2]
+        return None
+    
+    def _store_result(self, key, top_k, query_embedding, output):
+        """حفظ نتيجة البحث في الذاكرة المؤقتة"""
+        self.result_cache[(key, top_k)] = (time.time(), query_embedding, output)
+        self.result_cache.move_to_end((key, top_k))
+        if len(self.result_cache) > RESULT_CACHE_SIZE:
+            self.result_cache.popitem(last=False)
+    
+    def _search_vectors(self, query_embedding, top_k):
+        """إيجاد أقرب الأجزاء للسؤال"""
+        if self.embeddings is None:
+            with self._gpu_guard():
+                scores, indices = self.index.search(query_embedding, top_k)
+            return scores[0], indices[0]
+        
+        # ضرب مصفوفة في متجه ثم اختيار أعلى top_k بدون ترتيب كامل
+        scores = self.embeddings @ query_embedding[0]
+        k = min(top_k, len(scores))
+        if k < len(scores):
+            indices = np.argpartition(-scores, k)[:k]
+        else:
+            indices = np.arange(len(scores))
+        indices = indices[np.argsort(-scores[indices])]
+        return scores[indices], indices
+    
     def search(self, query, top_k=3):
         """بحث في المستند"""
-        if not self.is_ready or self.index is None:
+        if not self._wait_until_ready():
+            return self._not_ready_message()
+        
+        with self._state_lock:
+            return self._search_locked(query, top_k)
+    
+    def _search_locked(self, query, top_k):
+        """البحث مع ضمان ثبات حالة المستند حتى نهاية عرض النتائج"""
+        if self.index is None and self.embeddings is None:
             return "❌ يرجى معالجة مستند أولاً"
         
         try:
-            query_embedding = self.model.encode([query], normalize_embeddings=True)
-            scores, indices = self.index.search(query_embedding, top_k)
+            key = query.strip().lower()
+            cached = self._lookup_result(key, top_k)
+            if cached is not None:
+                return cached
+            
+            query_embedding = self._encode_query(query, key)
+            cached = self._lookup_result(key, top_k, query_embedding)
+            if cached is not None:
+                return cached
+            
+            scores, indices = self._search_vectors(query_embedding, top_k)
+            
+            # تحديد درجة التشابه لكل النتائج دفعة واحدة
+            buckets = np.searchsorted(SIMILARITY_THRESHOLDS, scores, side='right')
             
             results = []
-            for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-                if 0 <= idx < len(self.chunks):
-                    chunk = self.chunks[idx]
-                    
-                    # تحديد لون التشابه
-                    similarity_score = float(score)
-                    if similarity_score >= 0.5:
-                        sim_color = "#28a745"  # أخضر
-                        sim_text = "ممتاز"
-                    elif similarity_score >= 0.3:
-                        sim_color = "#ffc107"  # أصفر
-                        sim_text = "جيد"
-                    else:
-                        sim_color = "#dc3545"  # أحمر
-                        sim_text = "ضعيف"
-                    
-                    results.append(f"""
-                    <div style="background: #f8f9fa; border-radius: 10px; padding: 1.5rem; 
-                    margin: 1rem 0; border-left: 5px solid {sim_color}; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
-                        <h4 style="margin-top: 0;">🏆 النتيجة #{i+1}</h4>
-                        <p style="margin-bottom: 0.5rem;">
-                            <span style="color: {sim_color}; font-weight: bold;">التشابه: {score*100:.1f}% ({sim_text})</span> | 
-                            📖 الصفحة: {chunk['page']} | 
-                            🔢 الكلمات: {chunk['word_count']}
-                        </p>
-                        <hr style="margin: 0.5rem 0;">
-                        <p>{chunk['text'][:400]}...</p>
-                    </div>
-                    """)
+            for i, (score, idx, bucket) in enumerate(zip(scores, indices, buckets)):
+                if 0 <= idx < len(self.chunk_pages):
+                    sim_color = SIMILARITY_COLORS[bucket]
+                    results.append(RESULT_TEMPLATE.substitute(
+                        sim_color=sim_color,
+                        sim_text=SIMILARITY_LABELS[bucket],
+                        rank=i + 1,
+                        percent=f"{float(score)*100:.1f}",
+                        page=self.get_chunk_pages(idx),
+                        word_count=self.chunk_wordcounts[idx],
+                        body=self.get_chunk_text(idx)[:400]
+                    ))
             
             if not results:
-                return "❌ لم أجد نتائج ذات صلة في المستند"
+                output = "❌ لم أجد نتائج ذات صلة في المستند"
+            else:
+                output = f"<h3>🔍 تم العثور على {len(results)} نتيجة:</h3>" + "".join(results)
             
-            return f"<h3>🔍 تم العثور على {len(results)} نتيجة:</h3>" + "".join(results)
+            self._store_result(key, top_k, query_embedding, output)
+            return output
             
         except Exception as e:
             return f"❌ خطأ في البحث: {str(e)}"
 
-# ==================== إنشاء النظام ====================
-rag_system = FlowRAGSystem()
-init_result = rag_system.initialize()
-
 # ==================== واجهة Gradio ====================
-with gr.Blocks(title="🤖 نظام RAG الذكي للمستندات", theme=gr.themes.Soft()) as demo:
-    
-    # العنوان
-    gr.Markdown("""
-    # 🤖 نظام RAG الذكي للمستندات
-    ### بحث دلالي متقدم في ملفات PDF - يدعم العربية والإنجليزية
-    """)
-    
-    # منطقة التنبيهات
-    if init_result is not True:
-        gr.Warning(f"⚠️ {init_result}")
-    else:
-        gr.Info("✅ النظام جاهز للاستخدام")
-    
-    with gr.Row():
-        with gr.Column(scale=2):
-            # قسم رفع الملف
-            with gr.Group():
-                gr.Markdown("## 📁 رفع ومعالجة المستند")
-                file_input = gr.File(
-                    label="اختر ملف PDF",
-                    file_types=[".pdf"],
-                    type="binary"
-                )
-                process_btn = gr.Button("🚀 معالجة المستند", variant="primary")
-                process_output = gr.Markdown(label="حالة المعالجة")
-            
-            # قسم البحث
-            with gr.Group():
-                gr.Markdown("## 💬 اسأل عن المستند")
-                question_input = gr.Textbox(
-                    label="اكتب سؤالك هنا",
-                    placeholder="مثال: ما هي حالة التدفق؟ أو What is flow state?",
-                    lines=3
-                )
+def build_demo():
+    """بناء واجهة Gradio"""
+    with gr.Blocks(title="🤖 نظام RAG الذكي للمستندات", theme=gr.themes.Soft()) as demo:
+        
+        # العنوان
+        gr.Markdown("""
+        # 🤖 نظام RAG الذكي للمستندات
+        ### بحث دلالي متقدم في ملفات PDF - يدعم العربية والإنجليزية
+        """)
+        
+        with gr.Row():
+            with gr.Column(scale=2):
+                # قسم رفع الملف
+                with gr.Group():
+                    gr.Markdown("## 📁 رفع ومعالجة المستند")
+                    file_input = gr.File(
+                        label="اختر ملف PDF",
+                        file_types=[".pdf"],
+                        type="binary"
+                    )
+                    process_btn = gr.Button("🚀 معالجة المستند", variant="primary")
+                    process_output = gr.Markdown(label="حالة المعالجة")
                 
-                with gr.Row():
-                    top_k_slider = gr.Slider(
-                        minimum=1, maximum=5, value=3,
-                        label="عدد النتائج"
+                # قسم البحث
+                with gr.Group():
+                    gr.Markdown("## 💬 اسأل عن المستند")
+                    question_input = gr.Textbox(
+                        label="اكتب سؤالك هنا",
+                        placeholder="مثال: ما هي حالة التدفق؟ أو What is flow state?",
+                        lines=3
                     )
-                    search_btn = gr.Button("🔍 ابحث في المستند", variant="primary")
+                    
+                    with gr.Row():
+                        top_k_slider = gr.Slider(
+                            minimum=1, maximum=5, value=3,
+                            label="عدد النتائج"
+                        )
+                        search_btn = gr.Button("🔍 ابحث في المستند", variant="primary")
+                    
+                    search_output = gr.HTML(label="نتائج البحث")
+            
+            with gr.Column(scale=1):
+                # الشريط الجانبي
+                with gr.Group():
+                    gr.Markdown("## 💡 أسئلة سريعة")
+                    
+                    example_questions = [
+                        "ما هي حالة التدفق؟",
+                        "What is flow state?",
+                        "ما هي عناصر التجربة المثلى؟",
+                        "كيف يحقق الإنسان السعادة في العمل؟",
+                        "ما هو دور التركيز في التدفق؟"
+                    ]
+                    
+                    for question in example_questions:
+                        gr.Button(
+                            question,
+                            size="sm",
+                        ).click(
+                            fn=lambda q=question: q,
+                            inputs=[],
+                            outputs=[question_input]
+                        )
                 
-                search_output = gr.HTML(label="نتائج البحث")
-        
-        with gr.Column(scale=1):
-            # الشريط الجانبي
-            with gr.Group():
-                gr.Markdown("## 💡 أسئلة سريعة")
+                with gr.Group():
+                    gr.Markdown("## 🎯 نصائح البحث")
+                    gr.Markdown("""
+                    **لأفضل النتائج:**
+                    
+                    • استخدم مصطلحات محددة  
+                    • جرب اللغتين (عربي/إنجليزي)  
+                    • اطرح أسئلة واضحة  
+                    
+                    **مثال:**  
+                    ✅ "ما هي خصائص flow state؟"  
+                    ❌ "اشرح لي"
+                    """)
                 
-                example_questions = [
-                    "ما هي حالة التدفق؟",
-                    "What is flow state?",
-                    "ما هي عناصر التجربة المثلى؟",
-                    "كيف يحقق الإنسان السعادة في العمل؟",
-                    "ما هو دور التركيز في التدفق؟"
-                ]
+                with gr.Group():
+                    gr.Markdown("## 📊 معلومات النظام")
+                    status_text = gr.Markdown("📄 لم يتم معالجة أي مستند بعد")
+                    
+                    # تحديث حالة النظام
+                    def update_status():
+                        if rag_system.current_file:
+                            file_info = f"📄 الملف: {rag_system.current_file}"
+                            if rag_system.chunk_pages is not None and len(rag_system.chunk_pages):
+                                chunks_info = f" | 📊 الأجزاء: {len(rag_system.chunk_pages)}"
+                                if rag_system.embeddings is not None or rag_system.index is not None:
+                                    vectors_info = f" | 🧮 المتجهات: {len(rag_system.chunk_pages)}"
+                                    return file_info + chunks_info + vectors_info
+                                return file_info + chunks_info
+                            return file_info
+                        return "📄 لم يتم معالجة أي مستند بعد"
+                    
+                    status_display = gr.Markdown(update_status())
+        
+        # نصائح إضافية
+        gr.Markdown("---")
+        with gr.Row():
+            with gr.Column():
+                gr.Markdown("### 📚 عن النظام")
+                gr.Markdown("""
+                **التقنيات المستخدمة:**
                 
-                for question in example_questions:
-                    gr.Button(
-                        question,
-                        size="sm",
-                    ).click(
-                        fn=lambda q=question: q,
-                        inputs=[],
-                        outputs=[question_input]
-                    )
+                • 🤖 **Sentence Transformers** - نماذج embedding متعددة اللغات  
+                • ⚡ **FAISS** - بحث سريع في المتجهات  
+                • 📄 **PyPDF** - معالجة ملفات PDF  
+                • 🌐 **Gradio** - واجهة مستخدم تفاعلية
+                """)
             
-            with gr.Group():
-                gr.Markdown("## 🎯 نصائح البحث")
+            with gr.Column():
+                gr.Markdown("### 🌍 الدعم اللغوي")
                 gr.Markdown("""
-                **لأفضل النتائج:**
+                **اللغات المدعومة:**
                 
-                • استخدم مصطلحات محددة  
-                • جرب اللغتين (عربي/إنجليزي)  
-                • اطرح أسئلة واضحة  
+                • العربية - البحث والنتائج  
+                • الإنجليزية - البحث والنتائج  
+                • الفرنسية، الإسبانية، الألمانية - البحث الأساسي
                 
-                **مثال:**  
-                ✅ "ما هي خصائص flow state؟"  
-                ❌ "اشرح لي"
+                **المميزات:**  
+                ✓ بحث دلالي ذكي  
+                ✓ نتائج مرتبة حسب الصلة  
+                ✓ دعم ملفات كبيرة
                 """)
+        
+        # تذييل الصفحة
+        gr.Markdown("---")
+        gr.Markdown("""
+        <div style="text-align: center; color: #666;">
+            <p>🤖 نظام RAG للمستندات | إصدار HuggingFace Spaces</p>
+            <p>تقنية: FAISS + Sentence Transformers + Gradio | يدعم العربية والإنجليزية</p>
+        </div>
+        """)
+        
+        # ==================== معالجة الأحداث ====================
+        def process_file(file):
+            if file is None:
+                return "⚠️ يرجى اختيار ملف PDF أولاً"
             
-            with gr.Group():
-                gr.Markdown("## 📊 معلومات النظام")
-                status_text = gr.Markdown("📄 لم يتم معالجة أي مستند بعد")
-                
-                # تحديث حالة النظام
-                def update_status():
-                    if rag_system.current_file:
-                        file_info = f"📄 الملف: {rag_system.current_file}"
-                        if rag_system.chunks:
-                            chunks_info = f" | 📊 الأجزاء: {len(rag_system.chunks)}"
-                            if rag_system.index:
-                                vectors_info = f" | 🧮 المتجهات: {rag_system.index.ntotal}"
-                                return file_info + chunks_info + vectors_info
-                            return file_info + chunks_info
-                        return file_info
-                    return "📄 لم يتم معالجة أي مستند بعد"
-                
-                status_display = gr.Markdown(update_status())
-    
-    # نصائح إضافية
-    gr.Markdown("---")
-    with gr.Row():
-        with gr.Column():
-            gr.Markdown("### 📚 عن النظام")
-            gr.Markdown("""
-            **التقنيات المستخدمة:**
-            
-            • 🤖 **Sentence Transformers** - نماذج embedding متعددة اللغات  
-            • ⚡ **FAISS** - بحث سريع في المتجهات  
-            • 📄 **PyPDF** - معالجة ملفات PDF  
-            • 🌐 **Gradio** - واجهة مستخدم تفاعلية
-            """)
-        
-        with gr.Column():
-            gr.Markdown("### 🌍 الدعم اللغوي")
-            gr.Markdown("""
-            **اللغات المدعومة:**
-            
-            • العربية - البحث والنتائج  
-            • الإنجليزية - البحث والنتائج  
-            • الفرنسية، الإسبانية، الألمانية - البحث الأساسي
-            
-            **المميزات:**  
-            ✓ بحث دلالي ذكي  
-            ✓ نتائج مرتبة حسب الصلة  
-            ✓ دعم ملفات كبيرة
-            """)
-    
-    # تذييل الصفحة
-    gr.Markdown("---")
-    gr.Markdown("""
-    <div style="text-align: center; color: #666;">
-        <p>🤖 نظام RAG للمستندات | إصدار HuggingFace Spaces</p>
-        <p>تقنية: FAISS + Sentence Transformers + Gradio | يدعم العربية والإنجليزية</p>
-    </div>
-    """)
-    
-    # ==================== معالجة الأحداث ====================
-    def process_file(file):
-        if file is None:
-            return "⚠️ يرجى اختيار ملف PDF أولاً"
-        
-        result = rag_system.process_pdf(file)
-        return result
-    
-    def search_query(question, top_k):
-        if not question:
-            return "⚠️ يرجى إدخال سؤال"
-        
-        return rag_system.search(question, int(top_k))
-    
-    # ربط الأحداث
-    process_btn.click(
-        fn=process_file,
-        inputs=[file_input],
-        outputs=[process_output]
-    ).then(
-        fn=update_status,
-        inputs=[],
-        outputs=[status_display]
-    )
-    
-    search_btn.click(
-        fn=search_query,
-        inputs=[question_input, top_k_slider],
-        outputs=[search_output]
-    )
+            result = rag_system.process_pdf(file)
+            return result
+        
+        def search_query(question, top_k):
+            if not question:
+                return "⚠️ يرجى إدخال سؤال"
+            
+            return rag_system.search(question, int(top_k))
+        
+        # ربط الأحداث
+        process_btn.click(
+            fn=process_file,
+            inputs=[file_input],
+            outputs=[process_output]
+        ).then(
+            fn=update_status,
+            inputs=[],
+            outputs=[status_display]
+        )
+        
+        search_btn.click(
+            fn=search_query,
+            inputs=[question_input, top_k_slider],
+            outputs=[search_output]
+        )
+        
+        # معالجة ضغط Enter في حقل السؤال
+        question_input.submit(
+            fn=search_query,
+            inputs=[question_input, top_k_slider],
+            outputs=[search_output]
+        )
     
-    # معالجة ضغط Enter في حقل السؤال
-    question_input.submit(
-        fn=search_query,
-        inputs=[question_input, top_k_slider],
-        outputs=[search_output]
-    )
+    return demo
+
+# ==================== إنشاء النظام ====================
+# عمليات استخراج النص الفرعية تستورد هذا الملف باسم __mp_main__،
+# فلا نبني الواجهة ولا نحمّل النموذج داخلها
+if __name__ != "__mp_main__":
+    rag_system = FlowRAGSystem()
+    demo = build_demo()
 
 # ==================== تشغيل التطبيق ====================
 if __name__ == "__main__":
@@ -346,3 +915,4 @@ if __name__ == "__main__":
         server_name="0.0.0.0",
         server_port=7860,
         share=False
+    )
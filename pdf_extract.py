@@ -0,0 +1,59 @@
+import os
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pypdf import PdfReader
+
+# ==================== استخراج النص ====================
+# هذا الملف بلا أي آثار جانبية عند استيراده لأن العمليات الفرعية تستورده
+
+# أقل عدد صفحات يستحق تشغيل عمليات متوازية. الاستخراج يكلف ~4-5ms للصفحة،
+# بينما للعمليات تكلفة ثابتة (~15ms وتحميل App.py مرة واحدة في خادم forkserver)
+# و~0.4ms لكل صفحة للنقل بين العمليات، لذا الملفات الصغيرة والمتوسطة تبقى تسلسلية
+PARALLEL_EXTRACT_MIN_PAGES = 500
+
+_worker_reader = None
+
+def _init_extract_worker(pdf_bytes):
+    """فتح نسخة مستقلة من PDF داخل كل عملية"""
+    global _worker_reader
+    _worker_reader = PdfReader(io.BytesIO(pdf_bytes))
+
+def _extract_page_text(page_index):
+    """استخراج نص صفحة واحدة داخل عملية فرعية"""
+    return _worker_reader.pages[page_index].extract_text()
+
+def _get_mp_context():
+    """سياق العمليات: forkserver إن وُجد وإلا spawn، وليس fork أبداً"""
+    # fork من عملية فيها خيوط Gradio والنموذج قد يؤدي إلى تعليق العمليات
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        # تحميل الملف الرئيسي مرة واحدة في الخادم بدلاً من كل عملية
+        context.set_forkserver_preload(["__main__", __name__])
+        return context
+    return multiprocessing.get_context("spawn")
+
+def _available_cpus():
+    """عدد الأنوية المتاحة فعلاً لهذه العملية"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def iter_page_texts(pdf_bytes):
+    """استخراج نص الصفحات بالترتيب، بالتوازي للملفات الكبيرة"""
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    num_pages = len(reader.pages)
+    workers = _available_cpus()
+    
+    if num_pages < PARALLEL_EXTRACT_MIN_PAGES or workers < 2:
+        for page in reader.pages:
+            yield page.extract_text()
+        return
+    
+    with ProcessPoolExecutor(
+        max_workers=min(workers, num_pages),
+        mp_context=_get_mp_context(),
+        initializer=_init_extract_worker,
+        initargs=(pdf_bytes,)
+    ) as executor:
+        yield from executor.map(_extract_page_text, range(num_pages), chunksize=4)